@@ -9,101 +9,234 @@
 # - Provide an endpoint for the frontend to fetch the current server-side chat history.
 #
 # Notes:
-# - We keep a server-side sessions_state dict keyed by a session_id stored in the
+# - We keep a server-side sessions_state store (sharded dicts) keyed by a session_id stored in the
 #   Flask session cookie. This is required because background threads cannot access
 #   Flask's `session` object outside a request context.
-# - The frontend must poll /updates to retrieve model responses produced asynchronously.
-#   (You can wire this to a periodic Ajax / fetch call or use websockets/SSE for push.)
+# - sessions_state lives in process memory, so the app must run as a single worker
+#   process (see Procfile: one gunicorn worker, several threads). Otherwise /chat and
+#   /updates for the same user could land on workers with divergent state.
+# - Model responses produced asynchronously are pushed to the frontend over Server-Sent
+#   Events (/stream). /updates still returns the full server-side history on demand.
 # - The queue is debounced: each new request resets a 5-second timer. When that timer
 #   fires with no new requests, all queued messages at that moment are concatenated and
 #   processed in the background.
 # - While processing, new messages are allowed and go into a fresh queue for the next batch.
 #
 import os
+import queue
+import concurrent.futures
 import uuid
+import heapq
+import itertools
 import threading
 import time
-from flask import Flask, render_template, request, jsonify, session
+import traceback
+import orjson
+from flask import Flask, Response, render_template, request, jsonify, session
+from markupsafe import Markup
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
 import chatbot as bot
 
 # Tải các biến môi trường từ file .env
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (used by jsonify and app.json)."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'a_default_secret_key_for_development')
+app.json = OrjsonProvider(app)
 
 # Server-side state per-session_id (because background threads cannot access Flask session)
-# Structure:
-# sessions_state[session_id] = {
+# sessions_state is split into shards (dict + lock each) by hash(session_id), so creating
+# sessions for different users does not serialize on one lock. Structure of each entry:
+# state = {
 #   "queue": [str, ...],
-#   "timer": threading.Timer or None,
+#   "deadline": float or None,  # time.monotonic() at which the queue is flushed
 #   "lock": threading.Lock(),
-#   "chat_history": [...],  # same structure as before
-#   "order_state": {...},
+#   "chat_history": (...),  # immutable tuple of messages, replaced (never mutated) per batch
+#   "history_str": str,  # chat_history formatted for prompts, rebuilt when it changes
+#   "intent_context": str,  # last CLASSIFY_CONTEXT_MESSAGES messages, formatted
+#   "history_version": int,  # bumped whenever chat_history changes
+#   "updates_cache": (key, body) or None,  # last encoded /updates body
+#   "history_html_cache": (version, Markup) or None,  # last rendered chat pane
+#   "order_state": {...},  # see _reset_order_state_struct
 #   "last_query_result": ...,
-#   "processing": False
+#   "processing_evt": threading.Event(),  # set while a batch is being processed
+#   "batches_running": int,  # batches taken off the queue whose reply is not published yet
+#   "listeners": [queue.Queue, ...],  # one per open /stream connection
+#   "last_seen": float  # time.monotonic() of the last lookup, used for idle eviction
 # }
-sessions_state = {}
+SESSION_SHARDS = 32  # power of two
+_session_shards = [({}, threading.Lock()) for _ in range(SESSION_SHARDS)]
 # Maximum queued messages allowed before user must wait for batch to be processed
 MAX_QUEUE_SIZE = 10
 # Debounce delay (seconds)
 DEBOUNCE_SECONDS = 5.0
+# Keep only the most recent messages (10 user/model turns) so prompt size stays bounded
+MAX_HISTORY_MESSAGES = 20
+# Messages of context given to the intent classifier (intent rarely depends on older turns)
+CLASSIFY_CONTEXT_MESSAGES = 3
+# Intents that are routed to bot.handle_ordering outside of the confirmation step
+_ORDER_INTENTS = frozenset({"order_book", "edit_order", "confirm_order"})
+# Worker threads shared by all sessions for processing debounced batches
+BATCH_WORKERS = 16
+_BATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="bot-batch")
+# Sessions untouched for this long are evicted from memory by the janitor thread
+SESSION_IDLE_TTL_SECONDS = 15 * 60
+SESSION_SWEEP_INTERVAL_SECONDS = 60
+# Idle interval after which /stream sends a comment line to keep the connection alive
+SSE_KEEPALIVE_SECONDS = 15.0
+# A /stream response holds a server thread, so it only lives while a reply is pending:
+# it ends after each llm_response, or after SSE_MAX_SECONDS, and the browser reconnects
+# after SSE_RETRY_MS (resuming from the last event id)
+SSE_MAX_SECONDS = 30.0
+SSE_RETRY_MS = 1000
+
+def _shard_for(session_id):
+    return _session_shards[hash(session_id) & (SESSION_SHARDS - 1)]
+
+def get_server_session(session_id):
+    """Return the server-side state for session_id, or None if it was never initialized
+    (or was evicted after being idle)."""
+    shard, shard_lock = _shard_for(session_id)
+    # Lookup and last_seen refresh happen under the shard lock the janitor holds while
+    # evicting, so a state handed out here is never one the janitor is about to drop
+    with shard_lock:
+        state = shard.get(session_id)
+        if state is not None:
+            state["last_seen"] = time.monotonic()
+    return state
 
 def init_server_session(session_id):
     """Initialize server-side state for a new session_id."""
-    if session_id in sessions_state:
-        return sessions_state[session_id]
+    state = get_server_session(session_id)
+    if state is not None:
+        return state
 
     initial_message = "Book store xin chào! Tôi có thể giúp gì cho bạn?"
+    chat_history = ({"role": "model", "parts": [initial_message]},)
     state = {
         "queue": [],
-        "timer": None,
+        "deadline": None,
         "lock": threading.Lock(),
-        "chat_history": [{"role": "model", "parts": [initial_message]}],
-        "order_state": {
-            "cart": [], "customer_name": None, "phone": None,
-            "address": None, "confirming": False, "total_price": 0
-        },
+        "chat_history": chat_history,
+        "history_str": bot.format_history_for_prompt(chat_history),
+        "intent_context": bot.format_history_for_prompt(chat_history[-CLASSIFY_CONTEXT_MESSAGES:]),
+        "history_version": 0,
+        "updates_cache": None,
+        "history_html_cache": None,
+        "order_state": _reset_order_state_struct(),
         "last_query_result": None,
-        "processing": False
+        "processing_evt": threading.Event(),
+        "batches_running": 0,
+        "listeners": [],
+        "last_seen": time.monotonic()
     }
-    sessions_state[session_id] = state
-    return state
+    # Two first requests of the same session may race here; keep whichever state won
+    shard, shard_lock = _shard_for(session_id)
+    with shard_lock:
+        state = shard.setdefault(session_id, state)
+        state["last_seen"] = time.monotonic()
+        return state
 
 def _reset_order_state_struct():
+    # cart: {normalized title: {"title", "quantity", ...}}, in insertion order
     return {
-        "cart": [], "customer_name": None, "phone": None,
+        "cart": {}, "customer_name": None, "phone": None,
         "address": None, "confirming": False, "total_price": 0
     }
 
 def _process_batch_in_thread(session_id, batch_messages):
-    """Run actual processing in a background thread (so Timer thread isn't blocked)."""
-    thread = threading.Thread(target=_process_batch, args=(session_id, batch_messages), daemon=True)
-    thread.start()
+    """Run actual processing on the batch worker pool (so the scheduler thread isn't blocked).
+    When all workers are busy, batches wait in the executor's queue."""
+    future = _BATCH_EXECUTOR.submit(_process_batch, session_id, batch_messages)
+    future.add_done_callback(lambda f: _log_batch_failure(session_id, f))
+
+def _log_batch_failure(session_id, future):
+    """Print the traceback of a batch that raised (the executor would otherwise keep the
+    exception in the discarded Future, where nobody sees it)."""
+    e = future.exception()
+    if e is not None:
+        print(f"DEBUG: Batch processing failed for session {session_id}: {e!r}")
+        traceback.print_exception(e)
 
 def _process_batch(session_id, batch_messages):
     """Take a list of user messages (strings), concatenate them and run the bot logic.
     Update the server-side chat_history / order_state accordingly.
     """
-    state = sessions_state.get(session_id)
+    state = get_server_session(session_id)
     if state is None:
         return
 
     # Set processing flag (others can still enqueue new messages)
-    with state["lock"]:
-        state["processing"] = True
+    state["processing_evt"].set()
+    final_answer = None
+    try:
+        final_answer = _run_batch(state, batch_messages)
+    finally:
+        # Always release the batch, even if it raised, so the session never looks busy
+        # forever (which would keep /stream clients waiting and block idle eviction)
+        with state["lock"]:
+            state["batches_running"] -= 1
+            pending = _reply_pending(state)
+            # Push the new response (or, if nothing more is coming, an idle notice) to
+            # every open /stream connection of this session
+            if final_answer is not None:
+                event = {
+                    "type": "llm_response",
+                    "text": final_answer,
+                    "version": state["history_version"],
+                    "pending": pending,
+                }
+            elif not pending:
+                event = {"type": "idle", "version": state["history_version"]}
+            else:
+                event = None
+            if event is not None:
+                for listener in state["listeners"]:
+                    listener.put(event)
 
-    # Concatenate messages into a single prompt
-    concatenated = "\n".join(batch_messages).strip()
+        # Batch processed -> ensure processing flag false
+        # Note: we do NOT clear any messages that arrived after the snapshot was taken;
+        # they remain in state["queue"] for the next batch.
+        state["processing_evt"].clear()
+
+    print(f"DEBUG: Processed batch for session {session_id}. Batch size: {len(batch_messages)}")
+
+def _run_batch(state, batch_messages):
+    """Body of _process_batch. Returns the model answer once it has been published to
+    chat_history, or None if the batch had nothing to answer."""
+    # Drop repeated submissions of the same message (ignoring case and spacing), keeping
+    # the first occurrence, then concatenate into a single prompt
+    seen = set()
+    unique_messages = []
+    for message in batch_messages:
+        key = " ".join(message.lower().split())
+        if key and key not in seen:
+            seen.add(key)
+            unique_messages.append(message)
+    concatenated = "\n".join(unique_messages).strip()
     if not concatenated:
         # Nothing to do
-        with state["lock"]:
-            state["processing"] = False
-        return
+        return None
 
-    # Use a copy of current state to operate on and update in the end
-    chat_history = state.get("chat_history", [])
+    # The prompt-formatted history is rebuilt only when chat_history changes, so every
+    # LLM call of this batch shares one string instead of re-formatting the history
+    history_str = state["history_str"]
+    intent_context = state["intent_context"]
     order_state = state.get("order_state", {})
     last_query_result = state.get("last_query_result", None)
 
@@ -112,26 +245,44 @@ def _process_batch(session_id, batch_messages):
     user_input = concatenated
     final_answer = ""
 
+    def on_delta(text):
+        # Forward streamed FINAL_MODEL output to open /stream connections as it arrives;
+        # the complete answer still follows as a single llm_response event
+        with state["lock"]:
+            for listener in state["listeners"]:
+                listener.put({"type": "llm_delta", "text": text})
+
     try:
         if order_state.get("confirming"):
-            intent = bot.classify_intent(user_input, chat_history)
+            # Short answers to the order summary skip the LLM classifier entirely
+            intent = bot.quick_confirmation_intent(user_input) or bot.classify_intent(user_input, intent_context)
             print(f"DEBUG (Confirming, background): Intent -> {intent}")
 
             if intent == "confirm_order":
                 try:
-                    for item in order_state['cart']:
-                        res = bot.execute_sql_query("SELECT book_id FROM Books WHERE title = ?", (item['actual_title'],))
-                        book_id = res["data"][0][0]
-                        insert_sql = "INSERT INTO Orders (customer_name, phone, address, book_id, quantity, status) VALUES (?, ?, ?, ?, ?, ?)"
-                        params = (
+                    cart = order_state['cart'].values()
+                    titles = [item['actual_title'] for item in cart]
+                    placeholders = ",".join("?" * len(titles))
+                    res = bot.execute_sql_query(
+                        f"SELECT title, book_id FROM Books WHERE title IN ({placeholders})", tuple(titles)
+                    )
+                    book_ids = dict(res["data"])
+
+                    insert_sql = "INSERT INTO Orders (customer_name, phone, address, book_id, quantity, status) VALUES (?, ?, ?, ?, ?, ?)"
+                    order_rows = [
+                        (
                             order_state["customer_name"], order_state["phone"], order_state["address"],
-                            book_id, item["quantity"], "Pending"
+                            book_ids[item['actual_title']], item["quantity"], "Pending"
                         )
-                        bot.execute_sql_query(insert_sql, params)
+                        for item in cart
+                    ]
+                    update_sql = "UPDATE Books SET stock = stock - ? WHERE title = ?"
+                    stock_rows = [(item['quantity'], item['actual_title']) for item in cart]
 
-                    for item in order_state['cart']:
-                        update_sql = "UPDATE Books SET stock = stock - ? WHERE title = ?"
-                        bot.execute_sql_query(update_sql, (item['quantity'], item['actual_title']))
+                    # All inserts and stock updates are committed together (or not at all)
+                    result = bot.execute_transaction([(insert_sql, order_rows), (update_sql, stock_rows)])
+                    if "error" in result:
+                        raise RuntimeError(result["error"])
 
                     final_answer = "Đặt hàng thành công! Cảm ơn bạn đã mua sách. Tôi có thể giúp gì khác cho bạn không?"
                     order_state = _reset_order_state_struct()
@@ -142,25 +293,26 @@ def _process_batch(session_id, batch_messages):
 
             elif intent == "edit_order":
                 order_state["confirming"] = False
-                final_answer = bot.handle_ordering(user_input, order_state, chat_history, last_query_result)
+                final_answer = bot.handle_ordering(user_input, order_state, history_str, last_query_result, on_delta)
             else:  # Mặc định là cancel
                 order_state = _reset_order_state_struct()
                 final_answer = "Đã hủy đơn hàng. Tôi có thể giúp gì khác cho bạn không?"
 
         else:
-            intent = bot.classify_intent(user_input, chat_history)
+            # Bare greetings/thanks skip the LLM classifier
+            intent = bot.quick_chitchat_intent(user_input) or bot.classify_intent(user_input, intent_context)
             print(f"DEBUG (background): Intent -> {intent}")
             if intent == "chitchat":
-                final_answer = bot.handle_chitchat(user_input)
+                final_answer = bot.handle_chitchat(user_input, on_delta=on_delta)
                 last_query_result = None
             elif intent == "query_books":
-                final_answer, sql_result = bot.handle_query_books(user_input, chat_history)
+                final_answer, sql_result = bot.handle_query_books(user_input, history_str, on_delta)
                 if sql_result and "error" not in sql_result:
                     last_query_result = sql_result
             elif intent == "reconsider_order":
-                final_answer = bot.handle_reconsider_order(user_input, order_state)
-            elif intent in ["order_book", "edit_order", "confirm_order"]:
-                final_answer = bot.handle_ordering(user_input, order_state, chat_history, last_query_result)
+                final_answer = bot.handle_reconsider_order(user_input, order_state, on_delta)
+            elif intent in _ORDER_INTENTS:
+                final_answer = bot.handle_ordering(user_input, order_state, history_str, last_query_result, on_delta)
             else:
                 final_answer = "Xin lỗi, tôi chưa hiểu ý của bạn. Bạn muốn hỏi về sách, đặt hàng hay trò chuyện?"
     except Exception as e:
@@ -169,42 +321,123 @@ def _process_batch(session_id, batch_messages):
     # Append the user messages and model response to server-side chat_history
     # Note: we append the concatenated user input as a single user message
     with state["lock"]:
-        chat_history.append({"role": "user", "parts": [concatenated]})
-        chat_history.append({"role": "model", "parts": [final_answer]})
+        # Build on the current history (not our snapshot) so an overlapping batch is kept,
+        # and drop the oldest turns once the cap is exceeded
+        new_history = state["chat_history"] + (
+            {"role": "user", "parts": [concatenated]},
+            {"role": "model", "parts": [final_answer]},
+        )
+        state["chat_history"] = new_history[-MAX_HISTORY_MESSAGES:]
+        state["history_str"] = bot.format_history_for_prompt(state["chat_history"])
+        state["intent_context"] = bot.format_history_for_prompt(state["chat_history"][-CLASSIFY_CONTEXT_MESSAGES:])
 
         # Update order_state and last_query_result back to server state
-        state["chat_history"] = chat_history
+        state["history_version"] += 1
         state["order_state"] = order_state
         state["last_query_result"] = last_query_result
 
-        # Batch processed -> ensure processing flag false
-        state["processing"] = False
-        # Note: we do NOT clear any messages that arrived after the snapshot was taken;
-        # they remain in state["queue"] for the next batch.
+    return final_answer
 
-    print(f"DEBUG: Processed batch for session {session_id}. Batch size: {len(batch_messages)}")
+def _reply_pending(state):
+    """True while a model reply for this session is still to come (queued messages, a
+    running debounce or a batch being processed). Call with state["lock"] held."""
+    return bool(state["queue"]) or state["deadline"] is not None or state["batches_running"] > 0
 
 def _timer_callback(session_id):
-    """Timer callback called when debounce delay elapses with no new messages.
-    This will snapshot the current queue, clear those items from queue, and process them.
+    """Called by the scheduler when a session's heap entry comes due.
+    If new messages pushed the deadline back in the meantime, the entry is re-armed for
+    the new deadline; otherwise this snapshots the current queue, clears those items from
+    queue, and processes them.
     """
-    state = sessions_state.get(session_id)
+    state = get_server_session(session_id)
     if state is None:
         return
 
     # Snapshot and clear queued messages for this batch
     with state["lock"]:
-        queued = state["queue"][:]
-        state["queue"] = []
-        # Also clear the timer ref (we are in its callback)
-        state["timer"] = None
-
+        deadline = state["deadline"]
+        if deadline is None:
+            return
+        if deadline > time.monotonic():
+            queued = None
+        else:
+            queued = state["queue"][:]
+            state["queue"] = []
+            state["deadline"] = None
+            if queued:
+                state["batches_running"] += 1
+
+    if queued is None:
+        # The user kept typing: reset the entry's time instead of firing
+        _schedule_flush(session_id, deadline)
+        return
     if not queued:
         return
 
     # Start processing in a separate thread
     _process_batch_in_thread(session_id, queued)
 
+# Debounce scheduler: a single long-lived thread replaces one threading.Timer per message.
+# Heap entries are (fire_at, seq, session_id). Each waiting session has exactly one entry:
+# /chat only moves state["deadline"], and _timer_callback re-arms the entry if the
+# deadline moved later while it was waiting.
+_SCHED_HEAP = []
+_SCHED_COND = threading.Condition()
+_SCHED_COUNTER = itertools.count()
+
+def _schedule_flush(session_id, fire_at):
+    """Add a heap entry for session_id at fire_at and wake the scheduler thread."""
+    with _SCHED_COND:
+        heapq.heappush(_SCHED_HEAP, (fire_at, next(_SCHED_COUNTER), session_id))
+        _SCHED_COND.notify()
+
+def _scheduler_loop():
+    """Sleep until the earliest entry is due, then run its callback."""
+    while True:
+        with _SCHED_COND:
+            while True:
+                now = time.monotonic()
+                if _SCHED_HEAP and _SCHED_HEAP[0][0] <= now:
+                    _, _, session_id = heapq.heappop(_SCHED_HEAP)
+                    break
+                _SCHED_COND.wait(_SCHED_HEAP[0][0] - now if _SCHED_HEAP else None)
+
+        try:
+            _timer_callback(session_id)
+        except Exception as e:
+            print(f"DEBUG: Scheduler callback failed for session {session_id}: {e}")
+
+threading.Thread(target=_scheduler_loop, name="debounce-scheduler", daemon=True).start()
+
+def _evict_idle_sessions():
+    """Drop sessions that have been idle for SESSION_IDLE_TTL_SECONDS and have no pending
+    work (queued messages, running batch or open /stream connection)."""
+    cutoff = time.monotonic() - SESSION_IDLE_TTL_SECONDS
+    evicted = 0
+    for shard, shard_lock in _session_shards:
+        with shard_lock:
+            for session_id, state in list(shard.items()):
+                if (state["last_seen"] < cutoff and not state["queue"] and state["deadline"] is None
+                        and not state["processing_evt"].is_set() and not state["batches_running"]
+                        and not state["listeners"]):
+                    del shard[session_id]
+                    evicted += 1
+    if evicted:
+        print(f"DEBUG: Evicted {evicted} idle session(s)")
+
+def _session_janitor_loop():
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL_SECONDS)
+        try:
+            _evict_idle_sessions()
+        except Exception as e:
+            print(f"DEBUG: Session eviction failed: {e}")
+
+threading.Thread(target=_session_janitor_loop, name="session-janitor", daemon=True).start()
+
+# Establish the OpenAI connection in the background so the first /chat doesn't pay for it
+threading.Thread(target=bot.warm_up_client, name="openai-warmup", daemon=True).start()
+
 @app.route("/")
 def index():
     # Khởi tạo session cho người dùng mới
@@ -213,13 +446,20 @@ def index():
 
     session_id = session["session_id"]
     # Ensure server-side state exists and is initialized
-    init_server_session(session_id)
+    server_state = init_server_session(session_id)
 
     # Luôn truyền lịch sử chat cho template để hiển thị
     # NOTE: This renders from the server-side sessions_state chat_history. The frontend
-    # can also poll /updates to get new updates asynchronously.
-    server_state = sessions_state.get(session_id, {})
-    return render_template("index.html", chat_history=server_state.get("chat_history", []))
+    # receives new responses asynchronously through /stream. The chat pane is rendered
+    # once per history_version and reused on reloads (version is read before the history,
+    # as in /updates).
+    version = server_state["history_version"]
+    cached = server_state["history_html_cache"]
+    if cached is None or cached[0] != version:
+        html = Markup(render_template("_chat_history.html", chat_history=server_state["chat_history"]))
+        cached = (version, html)
+        server_state["history_html_cache"] = cached
+    return render_template("index.html", chat_history_html=cached[1], history_version=version)
 
 
 # Route API để xử lý tin nhắn chat (queues the message, debounces processing)
@@ -228,6 +468,8 @@ def chat():
     user_input = request.json.get("message")
     if user_input is None:
         return jsonify({"error": "No message provided"}), 400
+    if not isinstance(user_input, str):
+        return jsonify({"error": "Message must be a string"}), 400
 
     # Ensure session_id exists
     if "session_id" not in session:
@@ -246,53 +488,158 @@ def chat():
         # Append to queue
         state["queue"].append(user_input)
 
-        # Reset debounce timer: cancel old timer (if any), and start a new one
-        if state["timer"] is not None:
-            try:
-                state["timer"].cancel()
-            except Exception:
-                pass
-
-        timer = threading.Timer(DEBOUNCE_SECONDS, _timer_callback, args=(session_id,))
-        state["timer"] = timer
-        timer.daemon = True
-        timer.start()
+        # Reset debounce deadline; only an idle session needs a new scheduler entry
+        fire_at = time.monotonic() + DEBOUNCE_SECONDS
+        needs_entry = state["deadline"] is None
+        state["deadline"] = fire_at
 
         queued_count = len(state["queue"])
-        processing = state["processing"]
+
+    if needs_entry:
+        _schedule_flush(session_id, fire_at)
 
     # Immediately return acknowledgement to the client. The actual bot response will be
-    # produced asynchronously after the debounce delay and can be fetched from /updates.
+    # produced asynchronously after the debounce delay and delivered over /stream.
     return jsonify({
         "status": "queued",
         "queued": queued_count,
-        "processing": processing,
+        "processing": state["processing_evt"].is_set(),
         "message": f"Yêu cầu đã được thêm vào hàng đợi. Hệ thống sẽ gom các yêu cầu trong {DEBOUNCE_SECONDS} giây sau lần gửi cuối cùng."
     })
 
 
-# Endpoint for frontend to fetch the current server-side chat_history (and some state)
-# The frontend should poll this endpoint to retrieve responses produced asynchronously.
+# Endpoint returning the current server-side chat_history (and some state) on demand.
+# The bundled frontend receives replies over /stream and does not call it; it is kept
+# for other clients and for debugging, with ETag/304 support for pollers.
 @app.route("/updates", methods=["GET"])
 def updates():
     if "session_id" not in session:
         return jsonify({"error": "No session"}), 400
     session_id = session["session_id"]
-    state = sessions_state.get(session_id)
+    state = get_server_session(session_id)
     if state is None:
         return jsonify({"error": "Session not initialized"}), 400
 
-    with state["lock"]:
-        return jsonify({
-            "chat_history": state.get("chat_history", []),
-            "queue_length": len(state.get("queue", [])),
-            "processing": state.get("processing", False)
+    # Lock-free reads: _process_batch publishes chat_history (an immutable tuple) before
+    # bumping history_version, so reading the version first never pairs it with an older
+    # history.
+    processing = state["processing_evt"].is_set()
+    queue_length = len(state["queue"])
+    version = state["history_version"]
+    chat_history = state["chat_history"]
+    key = (version, queue_length, processing)
+    etag = f"{version}-{queue_length}-{int(processing)}"
+
+    # Nothing changed since the client's last poll
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    # Re-encode the (possibly long) history only when it actually changed. Concurrent
+    # polls may both rebuild; they store identical bodies for the same key.
+    cached = state["updates_cache"]
+    if cached is None or cached[0] != key:
+        body = app.json.dumps({
+            "chat_history": chat_history,
+            "queue_length": queue_length,
+            "processing": processing
         })
+        cached = (key, body)
+        state["updates_cache"] = cached
+
+    response = Response(cached[1], mimetype="application/json")
+    response.set_etag(etag, weak=True)
+    return response
+
+
+# Server-Sent Events endpoint: pushes each model response as soon as _process_batch
+# finishes, so the frontend does not need to poll /updates. While the answer is being
+# generated, "llm_delta" events carry the partial text; "llm_response" carries the final one
+# (with the history version as its event id).
+# Streams are short-lived so idle tabs do not hold gunicorn threads: the response ends
+# after one llm_response, after SSE_MAX_SECONDS, or at once with an "idle" event when no
+# reply is pending. The client passes the last history version it has seen (?since=, or
+# the Last-Event-ID header on automatic reconnects); replies published while it was not
+# connected are replayed from chat_history.
+@app.route("/stream", methods=["GET"])
+def stream():
+    # Like /chat, (re)create the session instead of refusing: EventSource gives up on a
+    # non-200 response, so after a restart or an idle eviction the page would stop
+    # receiving replies for good
+    if "session_id" not in session:
+        session["session_id"] = str(uuid.uuid4())
+    state = init_server_session(session["session_id"])
+
+    # Last-Event-ID (sent by the browser on automatic reconnects) is newer than the
+    # ?since= baked into the EventSource URL, so it wins when present
+    since = -1
+    for value in (request.headers.get("Last-Event-ID"), request.args.get("since")):
+        try:
+            since = int(value)
+            break
+        except (TypeError, ValueError):
+            pass
+
+    def generate():
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+
+        # Register (or decide to replay/finish) under the lock, so a reply published
+        # concurrently is either replayed here or delivered to the listener
+        listener = queue.Queue()
+        with state["lock"]:
+            version = state["history_version"]
+            pending = _reply_pending(state)
+            # A version ahead of ours comes from before a restart/eviction (versions start
+            # again at 0): treat it as a reset and replay everything published since then
+            seen = 0 if since > version else since
+            replay = []
+            if 0 <= seen < version:
+                replies = [msg["parts"][0] for msg in state["chat_history"] if msg["role"] == "model"]
+                replay = replies[-(version - seen):]
+            elif pending:
+                state["listeners"].append(listener)
+
+        if replay:
+            for text in replay:
+                event = {"type": "llm_response", "text": text, "version": version, "pending": pending}
+                yield f"id: {version}\ndata: {app.json.dumps(event)}\n\n"
+            return
+        if not pending:
+            yield f"data: {app.json.dumps({'type': 'idle', 'version': version})}\n\n"
+            return
+
+        try:
+            ends_at = time.monotonic() + SSE_MAX_SECONDS
+            while True:
+                remaining = ends_at - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = listener.get(timeout=min(remaining, SSE_KEEPALIVE_SECONDS))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event["type"] == "llm_response":
+                    yield f"id: {event['version']}\ndata: {app.json.dumps(event)}\n\n"
+                    return
+                if event["type"] == "idle":
+                    # The pending batch ended without a reply (e.g. it failed)
+                    yield f"data: {app.json.dumps(event)}\n\n"
+                    return
+                yield f"data: {app.json.dumps(event)}\n\n"
+        finally:
+            # Stream ended or client disconnected: stop delivering events to this connection
+            with state["lock"]:
+                state["listeners"].remove(listener)
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 if __name__ == "__main__":
     # Note: In production, you should run Flask with a WSGI server (gunicorn/uvicorn).
-    # Also be mindful: in multi-process deployments (multiple workers), in-memory
-    # sessions_state won't be shared across workers. For multi-worker production
-    # you must move sessions_state to a shared store (Redis, DB, etc.).
+    # sessions_state, its locks and the debounce timers are process-local, so the
+    # Procfile runs a single gunicorn worker and scales with threads instead. Moving
+    # to multiple workers requires moving sessions_state to a shared store first.
     app.run(debug=True)
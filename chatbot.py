@@ -1,13 +1,21 @@
 import os
+import hashlib
 import sqlite3
 import json
+import queue
 import re
-from thefuzz import process
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import orjson
+from rapidfuzz import fuzz, process, utils
 from pathlib import Path
 import time
+import unicodedata
+import httpx
 
 try:
-    from openai import OpenAI
+    from openai import DefaultHttpxClient, OpenAI
 except Exception:
     # If OpenAI SDK not installed, raise helpful error at import-time
     raise RuntimeError("OpenAI Python SDK not found. Install with `pip install openai` or the appropriate package.")
@@ -18,100 +26,336 @@ if not OPENAI_API_KEY:
     # Do not fail hard here — functions will raise when trying to call API if key is missing.
     pass
 
-# Initialize client
-client = OpenAI(api_key=OPENAI_API_KEY)
-
 # Model selection
 CLASSIFY_MODEL = os.getenv("CLASSIFY_MODEL", "gpt-3.5-turbo")   # for classify/sql/extraction
 FINAL_MODEL = os.getenv("FINAL_MODEL", "gpt-4o-mini")           # for final printed responses
 
 # OpenAI call defaults
 OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+# HTTP connection pool shared by all threads; sized for concurrent background batches
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "32"))
 
+# Initialize client
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=OPENAI_TIMEOUT,
+    http_client=DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_CONNECTIONS // 2,
+            keepalive_expiry=60.0
+        )
+    )
+)
 
-def _call_chat_model(model: str, messages: list, max_tokens: int = 512, temperature: float = 0.2):
+
+def warm_up_client():
+    """
+    Open a pooled connection to the API (TLS handshake included) before the first user
+    request needs it. Uses a model listing, so no tokens are spent. Errors are ignored.
+    """
+    try:
+        client.models.list()
+    except Exception:
+        pass
+
+
+# Exact-match response cache: identical (model, messages, max_tokens, temperature) calls
+# reuse the stored completion instead of going back to the API. Prompts embed the recent
+# history, so a hit only happens when the conversational context is the same too.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+_response_cache = OrderedDict()
+# Calls currently waiting on the API, by the same key: an identical concurrent call waits
+# for the first one's Future instead of sending a duplicate request
+_inflight = {}
+_response_cache_lock = threading.Lock()
+
+
+def _response_cache_key(model, messages, max_tokens, temperature):
+    payload = orjson.dumps([model, messages, max_tokens, temperature])
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def _call_chat_model(model: str, messages: list, max_tokens: int = 512, temperature: float = 0.2, on_delta=None):
+    """
+    Call the chat completions API, serving repeated identical calls from the LRU
+    response cache. Empty responses are not cached. While a call is in flight, identical
+    calls from other threads wait for its result rather than sending their own.
+    on_delta: optional callable; when given, the response is streamed and on_delta is
+    called with each text piece as it arrives (once with the whole text on a cache hit).
+    The full text is still returned.
+    """
+    key = _response_cache_key(model, messages, max_tokens, temperature)
+    with _response_cache_lock:
+        cached = _response_cache.get(key)
+        if cached is not None:
+            _response_cache.move_to_end(key)
+        else:
+            future = _inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = _inflight[key] = Future()
+    if cached is not None:
+        if on_delta is not None:
+            on_delta(cached)
+        return cached
+
+    if not is_owner:
+        # Re-raises the owner's exception if its call failed
+        content = future.result()
+        if on_delta is not None and content:
+            on_delta(content)
+        return content
+
+    try:
+        if on_delta is not None:
+            content = _stream_chat_completion(model, messages, max_tokens, temperature, on_delta)
+        else:
+            content = _request_chat_completion(model, messages, max_tokens, temperature)
+    except BaseException as e:
+        with _response_cache_lock:
+            del _inflight[key]
+        future.set_exception(e)
+        raise
+
+    with _response_cache_lock:
+        if content and RESPONSE_CACHE_SIZE > 0:
+            _response_cache[key] = content
+            _response_cache.move_to_end(key)
+            while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+        del _inflight[key]
+    future.set_result(content)
+    return content
+
+
+def _request_chat_completion(model: str, messages: list, max_tokens: int = 512, temperature: float = 0.2):
     """
     Call the chat completions API via the SDK.
     messages: list of {"role": "...", "content": "..."}
     Returns string content from the first choice (or raises Exception).
     """
+    resp = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature
+    )
+    return resp.choices[0].message.content or ""
+
+
+def _stream_chat_completion(model, messages, max_tokens, temperature, on_delta):
+    """
+    Call the chat completions API with stream=True, passing each content delta to
+    on_delta. Returns the concatenated text (or raises Exception).
+    """
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True
+    )
+    parts = []
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        piece = chunk.choices[0].delta.content
+        if piece:
+            parts.append(piece)
+            on_delta(piece)
+    return "".join(parts)
+
+
+# SQLite connection pool: connections are reused across calls (and threads) so the
+# connect/teardown cost is paid once and SQLite's page cache stays warm.
+DB_PATH = Path("bookstore.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+_conn_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+
+def _open_connection():
+    # isolation_level=None -> autocommit; multi-statement writes use explicit BEGIN/COMMIT
+    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+_db_exists = False
+
+
+def _database_available():
+    # Once the file has been seen it is assumed to stay; only a missing file is re-checked
+    global _db_exists
+    if not _db_exists:
+        _db_exists = DB_PATH.exists()
+    return _db_exists
+
+
+# Matches statements that reference the Books table (writes to it invalidate the caches)
+_BOOKS_TABLE_RE = re.compile(r"\bbooks\b", re.IGNORECASE)
+
+
+def _acquire_connection():
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            request_timeout=OPENAI_TIMEOUT
-        )
-        # Newer OpenAI SDK returns choices -> first -> message -> content
-        if resp and getattr(resp, "choices", None):
-            first = resp.choices[0]
-            # Some SDK shapes: choice.message.content or choice["message"]["content"]
-            content = None
-            if hasattr(first, "message") and isinstance(first.message, dict):
-                content = first.message.get("content")
-            elif hasattr(first, "message") and hasattr(first.message, "get"):
-                content = first.message.get("content")
-            else:
-                # try dict access
-                try:
-                    content = first["message"]["content"]
-                except Exception:
-                    pass
-            if content is None:
-                # try text or other keys
-                content = getattr(first, "text", None) or first.get("text", None)
-            return content or ""
-        # fallback: try to parse as dict
-        try:
-            data = resp.to_dict()
-            choices = data.get("choices", [])
-            if choices:
-                msg = choices[0].get("message") or {}
-                return msg.get("content") or choices[0].get("text") or ""
-        except Exception:
-            pass
-        return ""
-    except Exception as e:
-        raise
+        return _conn_pool.get_nowait()
+    except queue.Empty:
+        return _open_connection()
+
 
+def _release_connection(conn):
+    # Never hand a connection with an open transaction back to the pool
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _conn_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+def _books_read_authorizer(action, arg1, arg2, db_name, trigger):
+    # Only plain reads of the Books table (and SQL functions) are allowed; this rejects
+    # Orders, sqlite_master, PRAGMAs and every kind of write
+    if action in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION):
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_READ and arg1 == "Books":
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
 
-def execute_sql_query(sql_query, params=()):
+
+def execute_sql_query(sql_query, params=(), books_only=False):
     """
     Execute a SQL statement on bookstore.db.
-    Each call creates its own connection to be safe in multithreaded usage.
+    Uses a pooled connection; each connection is used by one thread at a time.
+    books_only: run under an authorizer that only permits reading the Books table
+    (for model-generated SQL).
     """
-    db_path = Path("bookstore.db")
-    if not db_path.exists():
+    if not _database_available():
         return {"error": "Database file not found."}
 
-    conn = sqlite3.connect(str(db_path))
-    cursor = conn.cursor()
+    conn = _acquire_connection()
     try:
-        cursor.execute(sql_query, params)
-        if sql_query.strip().upper().startswith("SELECT"):
+        if books_only:
+            # Setting an authorizer also expires cached statements, so none bypass it
+            conn.set_authorizer(_books_read_authorizer)
+        cursor = conn.execute(sql_query, params)
+        if sql_query.lstrip()[:6].upper() == "SELECT":
             rows = cursor.fetchall()
             column_names = [desc[0] for desc in cursor.description] if cursor.description else []
-            conn.close()
             if not rows:
                 return {"message": "Data not found!", "column": column_names, "data": []}
             return {"column": column_names, "data": rows}
-        else:
-            conn.commit()
-            conn.close()
-            return {"message": "Done successfully!"}
+        if _BOOKS_TABLE_RE.search(sql_query):
+            bump_books_version()
+        return {"message": "Done successfully!"}
     except Exception as e:
-        conn.close()
         return {"error": str(e)}
+    finally:
+        if books_only:
+            conn.set_authorizer(None)
+        _release_connection(conn)
 
 
-def classify_intent(user_input, chat_history):
+def _strip_code_fence(text, lang=""):
     """
-    Use CLASSIFY_MODEL (gpt-3.5-turbo) to return a single-word intent.
-    Possible outputs: 'chitchat', 'query_books', 'order_book', 'confirm_order', 'cancel_order', 'edit_order', 'reconsider_order'.
-    Returns lowercase one-word string (or 'chitchat' fallback).
+    Remove a surrounding ``` fence (optionally tagged with lang, e.g. ```sql) from a
+    model response. Only the ends are checked; the body is not rescanned.
+    """
+    s = text.strip()
+    if s.startswith("```"):
+        s = s[3:]
+        if lang and s[:len(lang)].lower() == lang:
+            s = s[len(lang):]
+    if s.endswith("```"):
+        s = s[:-3]
+    return s.strip()
+
+
+def execute_transaction(statements):
+    """
+    Execute several write statements on bookstore.db in a single transaction.
+    statements: list of (sql, params_list); each statement is run with executemany.
+    Either every statement is applied with one commit, or everything is rolled back.
+    """
+    if not _database_available():
+        return {"error": "Database file not found."}
+
+    conn = _acquire_connection()
+    try:
+        # Take the write lock once for the whole batch
+        conn.execute("BEGIN IMMEDIATE")
+        for sql_query, params_list in statements:
+            conn.executemany(sql_query, params_list)
+        conn.execute("COMMIT")
+        if any(_BOOKS_TABLE_RE.search(sql_query) for sql_query, _ in statements):
+            bump_books_version()
+        return {"message": "Done successfully!"}
+    except Exception as e:
+        return {"error": str(e)}
+    finally:
+        # Rolls back whatever part of the batch was applied before the error
+        _release_connection(conn)
+
+
+_ALLOWED_INTENTS = frozenset({
+    "chitchat", "query_books", "order_book", "confirm_order", "cancel_order", "edit_order", "reconsider_order"
+})
+# Finds the intent label anywhere in the reply, e.g. "'query_books'", "Intent: order_book."
+_INTENT_RE = re.compile(r"\b(" + "|".join(sorted(_ALLOWED_INTENTS)) + r")\b")
+
+
+# Short replies to the order summary ("chính xác", "sửa thông tin", "hủy") that can be
+# classified without an LLM call. Negations make a reply ambiguous ("không đúng").
+_CONFIRMATION_PATTERNS = (
+    ("confirm_order", re.compile(r"xác nhận|chính xác|đồng ý|\bđúng\b|\bok\b|\bokay\b")),
+    ("cancel_order", re.compile(r"\bhủy\b|\bhuỷ\b|\bcancel\b")),
+    ("edit_order", re.compile(r"\bsửa\b|\bedit\b|thay đổi")),
+)
+_NEGATION_RE = re.compile(r"\bkhông\b|\bchưa\b|\bko\b")
+QUICK_INTENT_MAX_CHARS = 20
+
+
+def quick_confirmation_intent(user_input):
+    """
+    Classify a short reply to the order confirmation prompt by keyword.
+    Returns 'confirm_order', 'cancel_order' or 'edit_order', or None when the reply is
+    long or ambiguous and should go through classify_intent instead.
+    """
+    text = user_input.strip().lower()
+    if len(text) >= QUICK_INTENT_MAX_CHARS or _NEGATION_RE.search(text):
+        return None
+    matches = [intent for intent, pattern in _CONFIRMATION_PATTERNS if pattern.search(text)]
+    return matches[0] if len(matches) == 1 else None
+
+
+# Messages that are only a greeting, thanks or goodbye (with polite particles) are
+# chitchat whatever the history says; anything longer goes to the LLM classifier.
+_CHITCHAT_ONLY_RE = re.compile(
+    r"(xin chào|chào|hello|hi|hey|cảm ơn|cám ơn|thanks|thank you|tạm biệt|bye)"
+    r"(\s+(bạn|shop|bot|em|anh|chị|ạ|nhé|nha|nhiều|rất nhiều))*[\s!.?~]*"
+)
+
+
+def quick_chitchat_intent(user_input):
+    """
+    Return 'chitchat' for a bare greeting/thanks/goodbye, else None.
+    Not for replies to the order confirmation prompt: there, anything that is not a
+    confirm/edit is treated as a cancel, so those go through quick_confirmation_intent.
+    """
+    text = user_input.strip().lower()
+    if len(text) < QUICK_INTENT_MAX_CHARS and _CHITCHAT_ONLY_RE.fullmatch(text):
+        return "chitchat"
+    return None
+
+
+def _classify_intent_llm(user_input, history_str):
+    """
+    LLM classification of (message, context). Repeats are served by the response cache
+    in _call_chat_model. API errors propagate to the caller.
     """
-    history_str = "\n".join([f"{msg['role']}: {msg['parts'][0]}" for msg in chat_history])
     system = (
         "You are a Vietnamese intent classifier for a bookstore assistant. "
         "Based on the conversation history and latest user message, return EXACTLY ONE word "
@@ -120,30 +364,34 @@ def classify_intent(user_input, chat_history):
         "Return only the intent token, nothing else."
     )
     user = f"History:\n{history_str}\n\nUser's latest message: \"{user_input}\""
+    resp_text = _call_chat_model(
+        model=CLASSIFY_MODEL,
+        messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+        max_tokens=16,
+        temperature=0.0
+    )
+    m = _INTENT_RE.search(resp_text.lower()) if resp_text else None
+    return m.group(1) if m else "chitchat"
+
+
+def classify_intent(user_input, history_str):
+    """
+    Use CLASSIFY_MODEL (gpt-3.5-turbo) to return a single-word intent.
+    history_str: recent conversation formatted with format_history_for_prompt. Callers
+    pass only the last few messages so repeated short replies hit the response cache.
+    Possible outputs: 'chitchat', 'query_books', 'order_book', 'confirm_order', 'cancel_order', 'edit_order', 'reconsider_order'.
+    Returns lowercase one-word string (or 'chitchat' fallback).
+    """
     try:
-        resp_text = _call_chat_model(
-            model=CLASSIFY_MODEL,
-            messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
-            max_tokens=16,
-            temperature=0.0
-        )
-        if not resp_text:
-            return "chitchat"
-        # sanitize to single token
-        intent = resp_text.strip().split()[0].strip().lower()
-        # Normalize common punctuation
-        intent = re.sub(r"[^a-z_]", "", intent)
-        allowed = {"chitchat", "query_books", "order_book", "confirm_order", "cancel_order", "edit_order", "reconsider_order"}
-        if intent not in allowed:
-            return "chitchat"
-        return intent
+        return _classify_intent_llm(user_input.strip(), history_str)
     except Exception:
         return "chitchat"
 
 
-def handle_chitchat(user_input, chat_history=None):
+def handle_chitchat(user_input, chat_history=None, on_delta=None):
     """
     Produce a short natural chitchat reply for the user using FINAL_MODEL (gpt-4o-mini).
+    on_delta: optional callback receiving the reply as it streams (see _call_chat_model).
     """
     prompt = (
         "Bạn là một trợ lý bán sách thân thiện. Trả lời ngắn gọn và tự nhiên (tối đa 2 câu) cho khách hàng.\n"
@@ -154,7 +402,8 @@ def handle_chitchat(user_input, chat_history=None):
             model=FINAL_MODEL,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=150,
-            temperature=0.6
+            temperature=0.6,
+            on_delta=on_delta
         )
         return resp_text or "Xin lỗi, tôi không rõ. Bạn vui lòng nói lại được không?"
     except Exception as e:
@@ -166,17 +415,23 @@ _VN_NUMBER_MAP = {
     "năm": 5, "nam": 5, "sáu": 6, "sau": 6, "bảy": 7, "bay": 7,
     "tám": 8, "tam": 8, "chín": 9, "chin": 9, "mười": 10, "muoi": 10
 }
+# One alternation over all number words (longest first) instead of a regex search per word
+_VN_NUMBER_RE = re.compile(
+    r"\b(" + "|".join(re.escape(w) for w in sorted(_VN_NUMBER_MAP, key=len, reverse=True)) + r")\b"
+)
+_PUNCT_RE = re.compile(r"[^\w\s]")
+_DIGIT_RE = re.compile(r"\b(\d{1,3})\b")
 
 
 def extract_quantity_from_text(text):
     if not text:
         return 1
     s = str(text).lower().strip()
-    s_clean = re.sub(r"[^\w\s]", " ", s)
-    for word, val in _VN_NUMBER_MAP.items():
-        if re.search(r"\b" + re.escape(word) + r"\b", s_clean):
-            return val
-    m = re.search(r"\b(\d{1,3})\b", s_clean)
+    s_clean = _PUNCT_RE.sub(" ", s)
+    m = _VN_NUMBER_RE.search(s_clean)
+    if m:
+        return _VN_NUMBER_MAP[m.group(1)]
+    m = _DIGIT_RE.search(s_clean)
     if m:
         return int(m.group(1))
     return 1
@@ -188,41 +443,189 @@ Table Orders has columns: order_id (INTEGER, PRIMARY KEY), customer_name (TEXT),
 """
 
 
-def get_database_context():
-    all_titles_res = execute_sql_query("SELECT DISTINCT title FROM Books")
-    all_categories_res = execute_sql_query("SELECT DISTINCT category FROM Books")
-    all_authors_res = execute_sql_query("SELECT DISTINCT author FROM Books")
+# Version of the Books catalogue, bumped by execute_sql_query/execute_transaction after
+# writes to Books so cached views of it (see get_database_context) are rebuilt on next use.
+_books_version = 0
+_books_version_lock = threading.Lock()
+_db_context_cache = {"version": -1, "value": None}
+_books_snapshot = {"version": -1, "titles": [], "match_keys": [], "price_stock": {}}
+
 
-    db_titles = [row[0] for row in all_titles_res.get('data', [])] if all_titles_res.get('data') else []
-    db_authors = [row[0] for row in all_authors_res.get('data', [])] if all_authors_res.get('data') else []
-    db_categories = [row[0] for row in all_categories_res.get('data', [])] if all_categories_res.get('data') else []
+def bump_books_version():
+    global _books_version
+    with _books_version_lock:
+        _books_version += 1
+
+
+def get_database_context():
+    """
+    Return the titles/authors/categories context string for the SQL prompt.
+    Cached until the Books version changes.
+    """
+    global _db_context_cache
+    # Read the version before querying so a concurrent write forces a rebuild next time
+    version = _books_version
+    cached = _db_context_cache
+    if cached["version"] == version:
+        return cached["value"]
+
+    # One round-trip for all three lists; each row is tagged with the list it belongs to.
+    # GROUP BY on the indexed columns lets SQLite walk each index instead of
+    # de-duplicating a full table scan
+    res = execute_sql_query(
+        "SELECT 't', title FROM Books GROUP BY title "
+        "UNION ALL SELECT 'a', author FROM Books GROUP BY author "
+        "UNION ALL SELECT 'c', category FROM Books GROUP BY category"
+    )
+    buckets = {"t": [], "a": [], "c": []}
+    for kind, value in res.get("data") or []:
+        if value is not None:
+            buckets[kind].append(value)
+    db_titles, db_authors, db_categories = buckets["t"], buckets["a"], buckets["c"]
 
     context = (
         f"DANH SÁCH TÊN SÁCH HIỆN CÓ:\n{', '.join(db_titles)}\n\n"
         f"DANH SÁCH TÁC GIẢ HIỆN CÓ:\n{', '.join(db_authors)}\n\n"
         f"DANH SÁCH THỂ LOẠI HIỆN CÓ:\n{', '.join(db_categories)}"
     )
+    # A failed read (e.g. database not created yet) must not be cached as the catalogue
+    if "error" not in res:
+        _db_context_cache = {"version": version, "value": context}
     return context
 
 
-def handle_query_books(user_input, chat_history):
+_COMBINING_MARKS_RE = re.compile("[\u0300-\u036f]")
+# Minimum WRatio score (0-100) for a requested title to count as a catalogue title
+TITLE_SCORE_THRESHOLD = 75
+
+
+def _fold_title(text):
+    """
+    Normalize a title for fuzzy matching: strip Vietnamese diacritics (đ -> d) and apply
+    rapidfuzz's default_process. Used for both the catalogue keys and the query, so
+    "dac nhan tam" and "Đắc nhân tâm" compare equal.
+    """
+    text = unicodedata.normalize("NFD", text).replace("đ", "d").replace("Đ", "D")
+    return utils.default_process(_COMBINING_MARKS_RE.sub("", text))
+
+
+def _match_title(requested_title, books):
     """
-    1) Use CLASSIFY_MODEL to generate SQL (only SQL code).
-    2) Execute SQL locally.
-    3) Use FINAL_MODEL to craft the final user-facing answer using SQL results.
+    Return the catalogue title (from a get_books_snapshot() result) that best matches
+    requested_title, or None if nothing scores at least TITLE_SCORE_THRESHOLD.
+    """
+    # WRatio in rapidfuzz's C++ core; titles are folded once in the snapshot, so only
+    # the query is folded here
+    best_match = process.extractOne(
+        _fold_title(requested_title), books["match_keys"],
+        scorer=fuzz.WRatio, processor=None, score_cutoff=TITLE_SCORE_THRESHOLD
+    )
+    return books["titles"][best_match[2]] if best_match else None
+
+
+def get_books_snapshot():
+    """
+    Return {"titles": [...], "match_keys": [...], "price_stock": {title: (price, stock)}}
+    for all books, loaded with a single query and cached until the Books version changes.
+    match_keys[i] is titles[i] already folded with _fold_title.
+    Returns None if the database cannot be read.
+    """
+    global _books_snapshot
+    version = _books_version
+    snapshot = _books_snapshot
+    if snapshot["version"] == version:
+        return snapshot
+
+    res = execute_sql_query("SELECT title, price, stock FROM Books")
+    if "error" in res:
+        return None
+    rows = res.get("data", [])
+    titles = [row[0] for row in rows]
+    snapshot = {
+        "version": version,
+        "titles": titles,
+        "match_keys": [_fold_title(t) for t in titles],
+        "price_stock": {row[0]: (row[1], row[2]) for row in rows},
+    }
+    _books_snapshot = snapshot
+    return snapshot
+
+
+# Parametrized queries the SQL step can pick from. The model only fills in the
+# parameters, so the statement text is fixed (and stays in sqlite3's statement cache).
+_BOOK_COLUMNS = "SELECT title, author, price, stock, category FROM Books"
+_SQL_TEMPLATES = {
+    "all_books": _BOOK_COLUMNS,
+    "by_title": _BOOK_COLUMNS + " WHERE title LIKE '%' || ? || '%'",
+    "by_author": _BOOK_COLUMNS + " WHERE author LIKE '%' || ? || '%'",
+    "by_category": _BOOK_COLUMNS + " WHERE category = ?",
+    "by_max_price": _BOOK_COLUMNS + " WHERE price <= ?",
+    "by_category_max_price": _BOOK_COLUMNS + " WHERE category = ? AND price <= ?",
+    "in_stock": _BOOK_COLUMNS + " WHERE stock > 0",
+}
+# Rows of a query result passed to the final prompt (and kept as last_query_result)
+MAX_PROMPT_ROWS = int(os.getenv("MAX_PROMPT_ROWS", "20"))
+# Free-form SQL from the model must be a single SELECT; it is also executed with
+# books_only=True, so it can read nothing but the Books table
+_READ_ONLY_SQL_RE = re.compile(r"^\s*select\b[^;]*;?\s*$", re.IGNORECASE)
+
+
+def _build_books_query(model_output):
+    """
+    Turn the SQL step's reply into (sql, params).
+    Expected reply: {"t": "<template name>", "p": [params]} or {"t": "other", "sql": "SELECT ..."}.
+    A bare SQL reply is treated like "other". Raises ValueError if nothing safe can be run.
+    """
+    text = _strip_code_fence(model_output, "json")
+    try:
+        spec = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        spec = {"t": "other", "sql": _strip_code_fence(model_output, "sql")}
+    if not isinstance(spec, dict):
+        raise ValueError("unexpected query spec")
+
+    template = _SQL_TEMPLATES.get(spec.get("t"))
+    if template is not None:
+        params = spec.get("p") or []
+        if not isinstance(params, list) or len(params) != template.count("?"):
+            raise ValueError(f"wrong parameters for template {spec.get('t')}")
+        return template, tuple(params)
+
+    sql = (spec.get("sql") or "").strip()
+    if not _READ_ONLY_SQL_RE.match(sql):
+        raise ValueError("only a single SELECT statement is allowed")
+    return sql, ()
+
+
+def handle_query_books(user_input, history_str, on_delta=None):
+    """
+    1) Use CLASSIFY_MODEL to pick a SQL template and its parameters (or, for anything
+       the templates cannot express, a single SELECT statement).
+    2) Execute the query locally.
+    3) Use FINAL_MODEL to craft the final user-facing answer using SQL results
+       (streamed to on_delta when given).
     Returns: (final_answer: str, sql_result: dict)
     """
     db_context = get_database_context()
-    history_str = "\n".join([f"{msg['role']}: {msg['parts'][0]}" for msg in chat_history])
 
     sql_prompt = (
-        "Bạn là một chuyên gia SQL. Nhiệm vụ: chuyển câu hỏi của người dùng thành một câu lệnh SQL chính xác. "
-        "Chỉ trả về một câu lệnh SQL duy nhất (KHÔNG có văn bản khác). Nếu cần, sử dụng thông tin ngữ cảnh dưới đây.\n\n"
+        "Bạn là một chuyên gia SQL. Nhiệm vụ: chọn mẫu truy vấn phù hợp với câu hỏi của người dùng và điền tham số. "
+        "Các mẫu có sẵn (tên: tham số):\n"
+        "- all_books: []\n"
+        "- by_title: [một phần tên sách]\n"
+        "- by_author: [một phần tên tác giả]\n"
+        "- by_category: [thể loại]\n"
+        "- by_max_price: [giá tối đa]\n"
+        "- by_category_max_price: [thể loại, giá tối đa]\n"
+        "- in_stock: []\n"
+        "Trả về JSON dạng {\"t\": \"tên mẫu\", \"p\": [tham số]}. Chỉ khi không mẫu nào phù hợp, trả về "
+        "{\"t\": \"other\", \"sql\": \"một câu lệnh SELECT duy nhất, chỉ đọc bảng Books\"}. "
+        "Dùng đúng tên sách/tác giả/thể loại trong ngữ cảnh dưới đây.\n\n"
         f"Ngữ cảnh từ CSDL:\n{db_context}\n\n"
         f"Cấu trúc CSDL:\n{DATABASE_SCHEMA}\n\n"
         f"Lịch sử trò chuyện:\n{history_str}\n\n"
         f"Câu hỏi của người dùng: \"{user_input}\"\n\n"
-        "CHỈ TRẢ VỀ MỘT CÂU LỆNH SQL."
+        "CHỈ TRẢ VỀ MỘT ĐỐI TƯỢNG JSON."
     )
 
     try:
@@ -234,31 +637,39 @@ def handle_query_books(user_input, chat_history):
         )
         if not generated_sql:
             return ("Xin lỗi, tôi không thể tạo câu lệnh truy vấn. Bạn vui lòng diễn đạt lại.", {"error": "empty_sql"})
-        # Clean up code fences if any
-        generated_sql = generated_sql.replace("```sql", "").replace("```", "").strip()
+        sql_query, params = _build_books_query(generated_sql)
     except Exception as e:
         return (f"Xin lỗi, lỗi khi tạo SQL: {e}", {"error": str(e)})
 
     # Execute SQL
     try:
-        sql_result = execute_sql_query(generated_sql)
+        sql_result = execute_sql_query(sql_query, params, books_only=True)
     except Exception as e:
         sql_result = {"error": str(e)}
 
+    # Keep the prompt bounded for broad queries; the model is told how many rows exist
+    rows = sql_result.get("data")
+    if rows and len(rows) > MAX_PROMPT_ROWS:
+        sql_result["data"] = rows[:MAX_PROMPT_ROWS]
+        sql_result["truncated"] = True
+        sql_result["total"] = len(rows)
+
     # Final answer assembled by FINAL_MODEL
     final_prompt = (
         "Bạn là trợ lý bán sách. Dựa vào dữ liệu dưới đây, trả lời khách hàng một cách thân thiện và rõ ràng.\n\n"
         f"Lịch sử: {history_str}\n\n"
         f"Câu hỏi: {user_input}\n\n"
-        f"Kết quả SQL (JSON-serializable): {json.dumps(sql_result, ensure_ascii=False)}\n\n"
-        "Trả lời ngắn gọn, dễ hiểu, và nếu không có dữ liệu, nói rõ 'không tìm thấy'."
+        f"Kết quả SQL (JSON-serializable): {orjson.dumps(sql_result).decode()}\n\n"
+        "Trả lời ngắn gọn, dễ hiểu, và nếu không có dữ liệu, nói rõ 'không tìm thấy'. "
+        "Nếu kết quả có truncated=true, chỉ là một phần của tổng số 'total' dòng: hãy nói rõ còn nhiều kết quả khác."
     )
     try:
         final_response = _call_chat_model(
             model=FINAL_MODEL,
             messages=[{"role": "user", "content": final_prompt}],
             max_tokens=300,
-            temperature=0.4
+            temperature=0.4,
+            on_delta=on_delta
         )
     except Exception as e:
         final_response = f"Xin lỗi, lỗi khi tạo phản hồi: {e}"
@@ -267,14 +678,16 @@ def handle_query_books(user_input, chat_history):
 
 
 def format_history_for_prompt(chat_history):
+    """Format a list of {"role", "parts"} messages as the 'role: text' lines used in prompts."""
     return "\n".join([f"{msg['role']}: {msg['parts'][0]}" for msg in chat_history])
 
 
-def handle_ordering(user_input, order_state, chat_history, last_query_result):
+def handle_ordering(user_input, order_state, history_str, last_query_result, on_delta=None):
     """
     1) Use CLASSIFY_MODEL to extract structured order info (JSON) from user_input.
     2) Update order_state based on extraction and DB lookup.
-    3) Use FINAL_MODEL to generate a friendly confirmation / follow-up message for the user.
+    3) Use FINAL_MODEL to generate a friendly confirmation / follow-up message for the user
+       (streamed to on_delta when given).
     Returns: final message string (to be printed).
     """
     formatted_last_query = "Không có"
@@ -286,7 +699,7 @@ def handle_ordering(user_input, order_state, chat_history, last_query_result):
         "Bạn là một trợ lý thông minh. Trích xuất thông tin đặt hàng từ tin nhắn của người dùng và trả về một JSON "
         "chứa: customer_name (string|null), phone (string|null), address (string|null), books (LIST of {title, quantity}).\n\n"
         f"Ngữ cảnh bổ sung (kết quả tra cứu gần nhất):\n{formatted_last_query}\n\n"
-        f"Lịch sử:\n{format_history_for_prompt(chat_history)}\n\n"
+        f"Lịch sử:\n{history_str}\n\n"
         f"Tin nhắn: \"{user_input}\"\n\n"
         "TRẢ VỀ CHỈ MỘT ĐỐI TƯỢNG JSON."
     )
@@ -297,8 +710,7 @@ def handle_ordering(user_input, order_state, chat_history, last_query_result):
             max_tokens=400,
             temperature=0.0
         )
-        cleaned_json_text = extraction_text.replace("```json", "").replace("```", "").strip()
-        extracted_info = json.loads(cleaned_json_text)
+        extracted_info = orjson.loads(_strip_code_fence(extraction_text, "json"))
     except Exception:
         # fallback: do not modify order_state; ask for clarification
         return "Xin lỗi, tôi chưa hiểu. Bạn có thể cho biết tên sách và số lượng rõ hơn không?"
@@ -312,43 +724,37 @@ def handle_ordering(user_input, order_state, chat_history, last_query_result):
         order_state["address"] = extracted_info["address"]
 
     if extracted_info.get("books"):
+        # The cart is keyed by lower-cased title, so repeating a title is a dict lookup
+        cart = order_state["cart"]
         for new_book in extracted_info.get("books"):
             requested_title = new_book.get("title")
             requested_qty = extract_quantity_from_text(new_book.get("quantity"))
             if not requested_title:
                 continue
-            found_in_cart = False
-            for cart_item in order_state["cart"]:
-                if requested_title.lower() in cart_item.get("title", "").lower():
-                    cart_item["quantity"] = requested_qty
-                    found_in_cart = True
-                    break
-            if not found_in_cart:
-                order_state["cart"].append({"title": requested_title, "quantity": requested_qty})
+            key = requested_title.lower().strip()
+            if key not in cart:
+                # Partial title of a book already in the cart (e.g. "Harry Potter")
+                key = next((cart_key for cart_key in cart if key in cart_key), key)
+            if key in cart:
+                cart[key]["quantity"] = requested_qty
+            else:
+                cart[key] = {"title": requested_title, "quantity": requested_qty}
 
     if not order_state["cart"]:
         return "Bạn muốn mua cuốn sách nào ạ?"
 
     # Validate stock/prices and prepare summary (local logic)
-    all_titles_res = execute_sql_query("SELECT title FROM Books")
-    if "error" in all_titles_res:
+    books = get_books_snapshot()
+    if books is None:
         return "Xin lỗi, không thể kết nối tới kho sách lúc này."
-    db_titles = [row[0] for row in all_titles_res.get('data', [])] if all_titles_res.get('data') else []
-
-    SCORE_THRESHOLD = 75
     total = 0
     cart_details_text = []
 
-    for item in order_state["cart"]:
-        item_title_lower = item['title'].lower().strip()
-        best_match = process.extractOne(item_title_lower, db_titles, score_cutoff=SCORE_THRESHOLD)
-        if not best_match:
+    for item in order_state["cart"].values():
+        found_title = _match_title(item['title'], books)
+        if not found_title:
             return f"Xin lỗi, không tìm thấy sách nào có tên giống '{item['title']}' trong kho. Bạn vui lòng kiểm tra lại chính tả nhé."
-        found_title = best_match[0]
-        res = execute_sql_query("SELECT price, stock FROM Books WHERE title = ?", (found_title,))
-        if "error" in res or not res.get("data"):
-            return "Xin lỗi, lỗi tra cứu thông tin sách."
-        price, stock = res["data"][0]
+        price, stock = books["price_stock"][found_title]
         qty = item["quantity"]
         if qty > stock:
             return f"Xin lỗi, cuốn '{found_title}' chỉ còn {stock} cuốn, không đủ {qty} cuốn bạn yêu cầu."
@@ -391,7 +797,8 @@ def handle_ordering(user_input, order_state, chat_history, last_query_result):
             model=FINAL_MODEL,
             messages=[{"role": "user", "content": final_prompt}],
             max_tokens=250,
-            temperature=0.4
+            temperature=0.4,
+            on_delta=on_delta
         )
     except Exception as e:
         final_response = summary_text + "\n" + follow_up
@@ -399,9 +806,10 @@ def handle_ordering(user_input, order_state, chat_history, last_query_result):
     return final_response
 
 
-def handle_reconsider_order(user_input, order_state):
+def handle_reconsider_order(user_input, order_state, on_delta=None):
     """
     Use FINAL_MODEL to provide a friendly follow-up when user wants to reconsider an order.
+    on_delta: optional callback receiving the reply as it streams (see _call_chat_model).
     """
     prompt = (
         "Bạn là một trợ lý bán sách. Người dùng muốn xem xét lại đơn hàng. Trả lời ngắn gọn "
@@ -412,7 +820,8 @@ def handle_reconsider_order(user_input, order_state):
             model=FINAL_MODEL,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=120,
-            temperature=0.5
+            temperature=0.5,
+            on_delta=on_delta
         )
         return resp or "Dạ, bạn muốn thay đổi điều gì trong đơn hàng ạ?"
     except Exception:
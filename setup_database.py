@@ -4,6 +4,13 @@ import sqlite3
 conn = sqlite3.connect("bookstore.db")
 cursor = conn.cursor()
 
+# Script chạy một lần: tắt fsync và giữ journal trong bộ nhớ, ghi toàn bộ trong một transaction.
+# page_size phải đặt trước khi tạo bảng; WAL được bật lại ở cuối cho ứng dụng.
+cursor.execute("PRAGMA page_size=4096")
+cursor.execute("PRAGMA journal_mode=MEMORY")
+cursor.execute("PRAGMA synchronous=OFF")
+cursor.execute("BEGIN")
+
 # Xoá bảng cũ
 cursor.execute("DROP TABLE IF EXISTS Books")
 cursor.execute("DROP TABLE IF EXISTS Orders")
@@ -34,6 +41,12 @@ CREATE TABLE Orders (
 )
 ''')
 
+# Index cho các cột tra cứu thường dùng và khoá ngoại của Orders
+cursor.execute("CREATE INDEX idx_books_title ON Books(title)")
+cursor.execute("CREATE INDEX idx_books_author ON Books(author)")
+cursor.execute("CREATE INDEX idx_books_category ON Books(category)")
+cursor.execute("CREATE INDEX idx_orders_book_id ON Orders(book_id)")
+
 # 30 sách mẫu
 books_data = [
     (1, 'Lược sử thời gian', 'Stephen Hawking', 150000, 20, 'Khoa học'),
@@ -83,6 +96,9 @@ cursor.executemany(
 )
 
 conn.commit()
+
+# Ứng dụng đọc/ghi đồng thời nên dùng WAL
+cursor.execute("PRAGMA journal_mode=WAL")
 conn.close()
 
 print("Cơ sở dữ liệu đã được tạo với 30 sách và 5 đơn hàng mẫu thành công!")
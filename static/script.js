@@ -3,6 +3,60 @@ document.addEventListener("DOMContentLoaded", function() {
     const userInput = document.getElementById("user-input");
     const chatBox = document.getElementById("chat-box");
 
+    // Nhận câu trả lời của bot do server đẩy về (Server-Sent Events).
+    // "llm_delta" là từng phần câu trả lời đang được sinh ra, "llm_response" là bản hoàn chỉnh.
+    // Kết nối chỉ mở khi đang chờ câu trả lời: server đóng stream sau mỗi "llm_response"
+    // (trình duyệt tự kết nối lại nếu còn "pending") hoặc gửi "idle" khi không còn gì để chờ.
+    let lastVersion = parseInt(chatBox.dataset.historyVersion, 10) || 0;
+    let events = null;
+    let pendingBotText = null;
+
+    function openStream() {
+        if (events !== null) return;
+        events = new EventSource(`/stream?since=${lastVersion}`);
+        events.onmessage = onStreamMessage;
+        events.onerror = function() {
+            // CLOSED: trình duyệt không tự kết nối lại nữa, lần gửi tin nhắn sau sẽ mở lại
+            if (events !== null && events.readyState === EventSource.CLOSED) {
+                events = null;
+            }
+        };
+    }
+
+    function closeStream() {
+        if (events !== null) {
+            events.close();
+            events = null;
+        }
+    }
+
+    function onStreamMessage(e) {
+        const data = JSON.parse(e.data);
+        if (data.type === "llm_delta") {
+            if (pendingBotText === null) {
+                pendingBotText = appendMessage("", "bot");
+            }
+            pendingBotText.textContent += data.text;
+            chatBox.scrollTop = chatBox.scrollHeight;
+        } else if (data.type === "llm_response") {
+            if (pendingBotText !== null) {
+                pendingBotText.textContent = data.text;
+                pendingBotText = null;
+            } else {
+                appendMessage(data.text, "bot");
+            }
+            lastVersion = data.version;
+            if (!data.pending) closeStream();
+        } else if (data.type === "idle") {
+            // Đồng bộ lại phiên bản (có thể đã về 0 sau khi server khởi động lại)
+            lastVersion = data.version;
+            closeStream();
+        }
+    }
+
+    // Lấy câu trả lời còn đang xử lý (ví dụ khi tải lại trang giữa chừng)
+    openStream();
+
     chatForm.addEventListener("submit", async function(e) {
         e.preventDefault();
         const messageText = userInput.value.trim();
@@ -22,13 +76,14 @@ document.addEventListener("DOMContentLoaded", function() {
                 body: JSON.stringify({ message: messageText }),
             });
 
+            const data = await response.json();
             if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
+                // Ví dụ: hàng đợi đã đầy (429)
+                appendMessage(data.error || `HTTP error! status: ${response.status}`, "bot");
+            } else {
+                openStream();
             }
-
-            const data = await response.json();
-            // Hiển thị câu trả lời của bot
-            appendMessage(data.response, "bot");
+            // Câu trả lời của bot sẽ được gửi về qua /stream sau khi hàng đợi được xử lý
 
         } catch (error) {
             console.error("Error:", error);
@@ -47,5 +102,6 @@ document.addEventListener("DOMContentLoaded", function() {
         chatBox.appendChild(messageDiv);
         // Tự động cuộn xuống tin nhắn mới nhất
         chatBox.scrollTop = chatBox.scrollHeight;
+        return p;
     }
 });
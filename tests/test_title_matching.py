@@ -0,0 +1,47 @@
+import os
+import unittest
+
+# chatbot creates its OpenAI client at import time; no request is made in these tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import chatbot as bot
+
+
+SEED_TITLES = [
+    "Lược sử thời gian", "Nhà giả kim", "Đắc nhân tâm", "Trí tuệ nhân tạo",
+    "Tư duy nhanh và chậm", "Dune", "Harry Potter và Hòn đá phù thủy", "Clean Code",
+    "Đại số tuyến tính",
+]
+
+
+def _books(titles):
+    return {"titles": titles, "match_keys": [bot._fold_title(t) for t in titles]}
+
+
+class TitleMatchingTest(unittest.TestCase):
+    def setUp(self):
+        self.books = _books(SEED_TITLES)
+
+    def test_unaccented_titles_resolve(self):
+        cases = {
+            "dac nhan tam": "Đắc nhân tâm",
+            "dai so tuyen tinh": "Đại số tuyến tính",
+            "tri tue nhan tao": "Trí tuệ nhân tạo",
+            "luoc su thoi gian": "Lược sử thời gian",
+            "nha gia kim": "Nhà giả kim",
+        }
+        for query, expected in cases.items():
+            with self.subTest(query=query):
+                self.assertEqual(bot._match_title(query, self.books), expected)
+
+    def test_accented_and_partial_titles_resolve(self):
+        self.assertEqual(bot._match_title("Đắc nhân tâm", self.books), "Đắc nhân tâm")
+        self.assertEqual(bot._match_title("clean cod", self.books), "Clean Code")
+        self.assertEqual(bot._match_title("harry potter", self.books), "Harry Potter và Hòn đá phù thủy")
+
+    def test_unknown_title_does_not_match(self):
+        self.assertIsNone(bot._match_title("chiến tranh và hòa bình", self.books))
+
+
+if __name__ == "__main__":
+    unittest.main()